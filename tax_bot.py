@@ -5,11 +5,39 @@ Telegram-бот — калькулятор налогов для ИП в Вен
 """
 
 import os
+import re
+import math
+import asyncio
 import logging
+import functools
+from bisect import bisect_left
+from collections import namedtuple
+from dataclasses import dataclass
 from datetime import datetime, timezone
 from dotenv import load_dotenv
+try:
+    import asyncpg
+except ImportError:  # без asyncpg статистика просто не пишется
+    asyncpg = None
+try:
+    import orjson
+except ImportError:  # без orjson ответы Bot API разбирает стандартный json
+    orjson = None
+try:
+    import uvloop
+except ImportError:  # uvloop нет под Windows — остаётся стандартный цикл asyncio
+    uvloop = None
+# numba намеренно не входит в requirements.txt: компиляция при первом вызове (~0.6 с)
+# блокировала бы цикл событий прямо в обработчике. Ставится вручную, где это приемлемо.
+try:
+    from numba import njit
+except ImportError:  # без numba ядро расчёта — обычная функция
+    def njit(*args, **kwargs):
+        return lambda fn: fn
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     CallbackQueryHandler,
@@ -30,49 +58,127 @@ logger = logging.getLogger(__name__)
 # === СТАТИСТИКА (PostgreSQL) ===
 ADMIN_ID = 266424785
 
-_db_conn = None
+_db_pool = None
+_db_lock = asyncio.Lock()
 
-def _get_db():
-    """Подключение к PostgreSQL (lazy)."""
-    global _db_conn
+
+# Индексы под запросы /stats
+_STATS_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS stats_events_event_created_idx "
+    "ON stats_events (event, created_at)",
+    "CREATE INDEX IF NOT EXISTS stats_events_start_user_idx "
+    "ON stats_events (user_id, created_at) WHERE event='start'",
+    "CREATE INDEX IF NOT EXISTS stats_events_calc_detail_idx "
+    "ON stats_events (detail) WHERE event='calc'",
+)
+
+
+async def _get_db():
+    """Пул подключений к PostgreSQL (lazy)."""
+    global _db_pool
     db_url = os.getenv('DATABASE_URL')
-    if not db_url:
+    if not db_url or asyncpg is None:
         return None
-    if _db_conn is None or _db_conn.closed:
-        import psycopg2
-        _db_conn = psycopg2.connect(db_url)
-        _db_conn.autocommit = True
-        with _db_conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS stats_events (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    username TEXT,
-                    event TEXT NOT NULL,
-                    detail TEXT,
-                    created_at TIMESTAMPTZ DEFAULT NOW()
-                )
-            """)
-    return _db_conn
+    async with _db_lock:
+        if _db_pool is None:
+            pool = await asyncpg.create_pool(db_url, min_size=1, max_size=4)
+            try:
+                await pool.execute("""
+                    CREATE TABLE IF NOT EXISTS stats_events (
+                        id SERIAL PRIMARY KEY,
+                        user_id BIGINT NOT NULL,
+                        username TEXT,
+                        event TEXT NOT NULL,
+                        detail TEXT,
+                        created_at TIMESTAMPTZ DEFAULT NOW()
+                    )
+                """)
+                # Индексы только ускоряют /stats: без них (например, таблица
+                # принадлежит другой роли) статистика всё равно пишется
+                for ddl in _STATS_INDEXES:
+                    try:
+                        await pool.execute(ddl)
+                    except Exception as e:
+                        logger.warning(f"Stats index error: {e}")
+            except BaseException:
+                # Иначе каждая повторная попытка оставляла бы открытым ещё один пул
+                await pool.close()
+                raise
+            _db_pool = pool
+    return _db_pool
+
+
+async def _close_db(application):
+    """post_shutdown: закрыть пул подключений."""
+    if _db_pool is not None:
+        await _db_pool.close()
+
+
+# События копятся в очереди и пишутся в БД пачками фоновой задачей
+STATS_BATCH_SIZE = 100
+STATS_FLUSH_INTERVAL = 2  # сек
+
+_stats_queue = asyncio.Queue()
+_stats_task = None
 
 
 def track(user_id, username, event, detail=None):
-    """Записать событие в БД."""
-    if user_id == ADMIN_ID:
+    """Поставить событие в очередь на запись в БД."""
+    if user_id == ADMIN_ID or asyncpg is None or not os.getenv('DATABASE_URL'):
         return
+    _stats_queue.put_nowait((user_id, username or '', event, detail))
+
+
+async def _flush_events(rows):
+    """Записать пачку событий одним COPY."""
     try:
-        conn = _get_db()
-        if conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO stats_events (user_id, username, event, detail) "
-                    "VALUES (%s, %s, %s, %s)",
-                    (user_id, username or '', event, detail),
-                )
+        pool = await _get_db()
+        if pool:
+            await pool.copy_records_to_table(
+                'stats_events', records=rows,
+                columns=('user_id', 'username', 'event', 'detail'),
+            )
     except Exception as e:
         logger.warning(f"Stats error: {e}")
 
 
+async def _stats_writer():
+    """Фоновая запись: по STATS_BATCH_SIZE событий или раз в STATS_FLUSH_INTERVAL сек."""
+    loop = asyncio.get_running_loop()
+    while True:
+        rows = [await _stats_queue.get()]
+        deadline = loop.time() + STATS_FLUSH_INTERVAL
+        try:
+            while len(rows) < STATS_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(await asyncio.wait_for(_stats_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            await _flush_events(rows)
+
+
+async def _start_stats_writer(application):
+    """post_init: запуск фоновой записи статистики."""
+    global _stats_task
+    _stats_task = asyncio.create_task(_stats_writer())
+
+
+async def _stop_stats_writer(application):
+    """post_stop: остановить запись и сбросить то, что осталось в очереди."""
+    if _stats_task is not None:
+        _stats_task.cancel()
+        await asyncio.gather(_stats_task, return_exceptions=True)
+    rows = []
+    while not _stats_queue.empty():
+        rows.append(_stats_queue.get_nowait())
+    if rows:
+        await _flush_events(rows)
+
+
 # === СТАВКИ НАЛОГОВ ВЕНГРИИ 2026 ===
 SZJA_RATE = 0.15
 SZOCHO_RATE = 0.13
@@ -93,47 +199,130 @@ HIPA_SAVOS = [     # (лимит оборота/год, фикс. база)
     (18_000_000, 6_000_000),
     (25_000_000, 8_500_000),
 ]
+_SZJA_EXEMPT_MONTHLY = SZJA_EXEMPT / 12
+# Лимиты и готовые суммы sávos HIPA для поиска bisect'ом
+_HIPA_LIMITS = tuple(limit for limit, _ in HIPA_SAVOS)
+_HIPA_TAXES = tuple(base * HIPA_RATE for _, base in HIPA_SAVOS)
+
+# Константы, зависящие только от базы мин. взносов (и доли HIPA в обратном расчёте)
+_WageConsts = namedtuple('_WageConsts', [
+    'min_szocho', 'min_tb', 'min_social',
+    'threshold_net', 'threshold_tax',
+])
+
+
+def _wage_consts(wage_base, hipa_rate=0):
+    min_szocho = wage_base * SZOCHO_RATE
+    min_tb = wage_base * TB_RATE
+    return _WageConsts(
+        min_szocho=min_szocho,
+        min_tb=min_tb,
+        min_social=min_szocho + min_tb,
+        threshold_net=wage_base * (1 - TOTAL_TAX_RATE - hipa_rate),
+        threshold_tax=wage_base * (TOTAL_TAX_RATE + hipa_rate),
+    )
+
+
+_WAGE_CONSTS = {
+    (w, h): _wage_consts(w, h)
+    for w in (MIN_WAGE, GUAR_WAGE) for h in (0, HIPA_RATE)
+}
+
+_MODE_REVENUE, _MODE_NET, _MODE_TAX = range(3)
+_MODE_IDS = {'revenue': _MODE_REVENUE, 'net': _MODE_NET, 'tax': _MODE_TAX}
+
+# Результат расчёта (месячные суммы); неизменяемый, чтобы его можно было кэшировать
+TaxResult = namedtuple('TaxResult', [
+    'revenue', 'expenses', 'profit', 'szja', 'szocho', 'tb',
+    'total_tax', 'net', 'szja_exempt', 'kata', 'extra_tax', 'is_kata',
+], defaults=(0, 0, 0, False))
+
+# Бот обрабатывает только сообщения и нажатия inline-кнопок — остальное Telegram не присылает
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
 
 # Состояния ConversationHandler
 TAX_REGIME, TAX_COST_RATIO, TAX_EXPENSES, TAX_WAGE_BASE, TAX_INPUT_MODE, TAX_NUMBER = range(6)
 
 
+@dataclass(slots=True)
+class TaxSession:
+    """Выбор пользователя в диалоге /tax (хранится в user_data['s'])"""
+    regime: str = ''
+    mode: str = ''
+    expense_pct: float = 0.0
+    wage_base: int = MIN_WAGE
+
+
 # === РАСЧЁТНЫЕ ФУНКЦИИ ===
 
+_SPACE_TABLE = str.maketrans({",": " "})
+
+
 def fmt(n):
     """1000000 → 1 000 000"""
-    if n < 0:
-        return f"-{abs(n):,.0f}".replace(",", " ")
-    return f"{n:,.0f}".replace(",", " ")
+    return _fmt_int(round(n))
 
 
-def calc_taxes(regime, mode, amount, expense_pct=0, wage_base=None):
+@functools.lru_cache(maxsize=1024)
+def _fmt_int(n):
+    # Суммы округлены до форинта — одни и те же значения (лимиты, базы) повторяются
+    return format(n, ",d").translate(_SPACE_TABLE)
+
+
+def calc_taxes(regime, mode, amount, expense_pct=0, wage_base=None, hipa_rate=0):
     """
     Расчёт налогов (месячные суммы).
     regime: 'standard' | 'atalany' | 'kata'
     mode:   'revenue' | 'net' | 'tax'
     wage_base: MIN_WAGE или GUAR_WAGE (база мин. взносов)
+    hipa_rate: доля прибыли на HIPA, уже включённая в amount для 'net'/'tax'
+               (HIPA выше sávos); сама HIPA в результат не входит
     """
-    if regime == 'kata':
-        return _calc_kata(mode, amount)
-
     if wage_base is None:
         wage_base = MIN_WAGE
+    # Квантуем входы, чтобы повторные расчёты попадали в кэш
+    return _calc_taxes_cached(
+        regime, mode, round(amount, 2), round(expense_pct, 4), wage_base, hipa_rate)
 
-    expense_ratio = expense_pct / 100
-    min_szocho = wage_base * SZOCHO_RATE
-    min_tb = wage_base * TB_RATE
-    min_social = min_szocho + min_tb
 
+@functools.lru_cache(maxsize=4096)
+def _calc_taxes_cached(regime, mode, amount, expense_pct, wage_base, hipa_rate):
+    """calc_taxes с кэшем (аргументы уже квантованы)."""
+    if regime == 'kata':
+        return _calc_kata(mode, amount, hipa_rate)
+
+    c = _WAGE_CONSTS.get((wage_base, hipa_rate)) or _wage_consts(wage_base, hipa_rate)
     # Льгота SZJA для Átalányadó (месячная)
-    exempt = SZJA_EXEMPT / 12 if regime == 'atalany' else 0
+    exempt = _SZJA_EXEMPT_MONTHLY if regime == 'atalany' else 0.0
 
-    if mode == 'revenue':
+    revenue, expenses, profit, szja, szocho, tb = _tax_core(
+        _MODE_IDS[mode], float(amount), expense_pct / 100, float(wage_base),
+        exempt, float(hipa_rate), *c)
+    total_tax = szja + szocho + tb
+
+    return TaxResult(
+        revenue=revenue, expenses=expenses, profit=profit,
+        szja=szja, szocho=szocho, tb=tb,
+        szja_exempt=exempt,
+        total_tax=total_tax, net=profit - total_tax,
+    )
+
+
+@njit(cache=True, fastmath=True)
+def _tax_core(mode_id, amount, expense_ratio, wage_base, exempt, hipa_rate,
+              min_szocho, min_tb, min_social, threshold_net, threshold_tax):
+    """
+    Числовое ядро calc_taxes (компилируется numba, если установлена).
+    min_szocho ... threshold_tax: поля _WageConsts отдельными float —
+    кортеж numba упаковывала бы заново на каждом вызове
+    → (revenue, expenses, profit, szja, szocho, tb)
+    """
+    if mode_id == _MODE_REVENUE:
         revenue = amount
         expenses = revenue * expense_ratio
         profit = revenue - expenses
 
-    elif mode == 'net':
+    elif mode_id == _MODE_NET:
         net = amount
         # Сначала пробуем: прибыль > льготы (SZJA платится на profit - exempt)
         # net = profit - (profit - exempt)*SZJA - szocho - tb
@@ -142,76 +331,64 @@ def calc_taxes(regime, mode, amount, expense_pct=0, wage_base=None):
         #   = profit*0.685 - profit*0.15 + exempt*0.15
         #   = profit*0.535 + exempt*0.15
         # profit = (net - exempt*0.15) / 0.535
+        # С hipa_rate из net дополнительно вычитается profit*hipa_rate
         if exempt > 0:
-            profit_try = (net - exempt * SZJA_RATE) / (1 - TOTAL_TAX_RATE)
-            if profit_try >= wage_base and profit_try > exempt:
-                profit = profit_try
-            elif profit_try <= exempt:
-                # Весь доход в пределах льготы — SZJA = 0
-                # net = profit - szocho - tb = profit - max(profit*0.315, min_social)
-                if net >= wage_base * (1 - SZOCHO_RATE - TB_RATE):
-                    profit = net / (1 - SZOCHO_RATE - TB_RATE)
-                else:
-                    profit = net + min_social
-            else:
-                profit = (net + min_social - exempt * SZJA_RATE) / (1 - SZJA_RATE)
+            # net(profit) непрерывна и возрастает, участки (exempt < wage_base):
+            #   profit >= wage_base:          net = profit*0.535 + exempt*0.15
+            #   exempt < profit < wage_base:  net = profit*0.85 + exempt*0.15 - min_social
+            #   profit <= exempt (SZJA = 0):  net = profit - min_social
+            # Решаем сверху вниз, пока результат не попадёт в свой участок
+            profit = (net - exempt * SZJA_RATE) / (1 - TOTAL_TAX_RATE - hipa_rate)
+            if profit < wage_base:
+                profit = (net + min_social - exempt * SZJA_RATE) / (1 - SZJA_RATE - hipa_rate)
+                if profit <= exempt:
+                    profit = (net + min_social) / (1 - hipa_rate)
         else:
-            threshold = wage_base * (1 - TOTAL_TAX_RATE)
-            if net >= threshold:
-                profit = net / (1 - TOTAL_TAX_RATE)
+            if net >= threshold_net:
+                profit = net / (1 - TOTAL_TAX_RATE - hipa_rate)
             else:
-                profit = (net + min_social) / (1 - SZJA_RATE)
+                profit = (net + min_social) / (1 - SZJA_RATE - hipa_rate)
         revenue = profit / (1 - expense_ratio) if expense_ratio < 1 else profit
         expenses = revenue * expense_ratio
 
-    elif mode == 'tax':
+    else:  # _MODE_TAX
         tax = amount
         # tax = szja + szocho + tb
         # szja = max(profit - exempt, 0) * 0.15
+        # С hipa_rate в tax дополнительно входит profit*hipa_rate
         if exempt > 0:
             # Если tax покрывает полные взносы: profit > wage_base и profit > exempt
             # tax = (profit-exempt)*0.15 + profit*0.13 + profit*0.185
             #     = profit*0.465 - exempt*0.15
-            profit_try = (tax + exempt * SZJA_RATE) / TOTAL_TAX_RATE
+            profit_try = (tax + exempt * SZJA_RATE) / (TOTAL_TAX_RATE + hipa_rate)
             if profit_try >= wage_base and profit_try > exempt:
                 profit = profit_try
             elif tax > min_social:
                 # Минимумы + частичный SZJA
-                profit = (tax - min_social + exempt * SZJA_RATE) / SZJA_RATE
+                profit = (tax - min_social + exempt * SZJA_RATE) / (SZJA_RATE + hipa_rate)
                 if profit < 0:
-                    profit = 0
+                    profit = 0.0
             else:
-                profit = 0
+                profit = 0.0
         else:
-            threshold = wage_base * TOTAL_TAX_RATE
-            if tax >= threshold:
-                profit = tax / TOTAL_TAX_RATE
+            if tax >= threshold_tax:
+                profit = tax / (TOTAL_TAX_RATE + hipa_rate)
             elif tax > min_social:
-                profit = (tax - min_social) / SZJA_RATE
+                profit = (tax - min_social) / (SZJA_RATE + hipa_rate)
             else:
-                profit = 0
+                profit = 0.0
         revenue = profit / (1 - expense_ratio) if expense_ratio < 1 else profit
         expenses = revenue * expense_ratio
 
     # Для Átalányadó: доход до SZJA_EXEMPT/12 в месяц освобождён от SZJA
-    szja_exempt_monthly = SZJA_EXEMPT / 12 if regime == 'atalany' else 0
-    taxable_for_szja = max(profit - szja_exempt_monthly, 0)
-    szja = taxable_for_szja * SZJA_RATE
-
+    szja = max(profit - exempt, 0.0) * SZJA_RATE
     szocho = max(profit * SZOCHO_RATE, min_szocho)
     tb = max(profit * TB_RATE, min_tb)
-    total_tax = szja + szocho + tb
-    net_result = profit - total_tax
-
-    return {
-        'revenue': revenue, 'expenses': expenses, 'profit': profit,
-        'szja': szja, 'szocho': szocho, 'tb': tb,
-        'szja_exempt': szja_exempt_monthly,
-        'total_tax': total_tax, 'net': net_result,
-    }
+    return revenue, expenses, profit, szja, szocho, tb
 
 
-def _calc_kata(mode, amount):
+@functools.lru_cache(maxsize=1024)
+def _calc_kata(mode, amount, hipa_rate=0):
     """KATA: фикс. 50 000 Ft/мес + 40% сверх лимита."""
     kata = KATA_MONTHLY
     extra = 0
@@ -225,9 +402,9 @@ def _calc_kata(mode, amount):
 
     elif mode == 'net':
         net = amount
-        revenue = net + kata
+        revenue = (net + kata) / (1 - hipa_rate)
         if revenue * 12 > KATA_LIMIT:
-            revenue = (net + kata - KATA_LIMIT * 0.4 / 12) / 0.6
+            revenue = (net + kata - KATA_LIMIT * 0.4 / 12) / (0.6 - hipa_rate)
             extra = (revenue * 12 - KATA_LIMIT) * 0.40 / 12
         total_tax = kata + extra
         net = revenue - total_tax
@@ -237,24 +414,55 @@ def _calc_kata(mode, amount):
         total_tax = kata
         net = 0
 
-    return {
-        'revenue': revenue, 'expenses': 0, 'profit': revenue,
-        'szja': 0, 'szocho': 0, 'tb': 0,
-        'kata': kata, 'extra_tax': extra,
-        'total_tax': total_tax, 'net': net,
-        'is_kata': True,
-    }
+    return TaxResult(
+        revenue=revenue, expenses=0, profit=revenue,
+        szja=0, szocho=0, tb=0,
+        kata=kata, extra_tax=extra,
+        total_tax=total_tax, net=net,
+        is_kata=True,
+    )
 
 
 def calc_hipa_yearly(revenue_yearly, profit_yearly):
     """HIPA: sávos до 25M, стандарт выше."""
-    for limit, base in HIPA_SAVOS:
-        if revenue_yearly <= limit:
-            return base * HIPA_RATE
+    i = bisect_left(_HIPA_LIMITS, revenue_yearly)
+    if i < len(_HIPA_TAXES):
+        return _HIPA_TAXES[i]
     # > 25M: база ≈ прибыль (упрощённо)
     return profit_yearly * HIPA_RATE
 
 
+def calc_taxes_with_hipa(regime, mode, amount, expense_pct=0, wage_base=None):
+    """
+    calc_taxes, где для 'net'/'tax' amount уже включает HIPA.
+    До 25M HIPA фиксирована в пределах полосы sávos — пробуем полосы по очереди
+    и берём первую, в которую попадает оборот; выше 25M HIPA = прибыль × 2%
+    и решается прямо в уравнениях calc_taxes.
+    """
+    if mode == 'revenue':
+        return calc_taxes(regime, mode, amount, expense_pct, wage_base)
+
+    prev_limit = -1
+    fallback = None
+    for limit, base in HIPA_SAVOS:
+        hipa_mo = base * HIPA_RATE / 12
+        adj = amount + hipa_mo if mode == 'net' else max(amount - hipa_mo, 0)
+        result = calc_taxes(regime, mode, adj, expense_pct, wage_base)
+        rev_yr = result.revenue * 12
+        if rev_yr <= limit:
+            if rev_yr > prev_limit:
+                return result
+            # Оборот «перескочил» границу полосы — точного решения нет
+            if fallback is None:
+                fallback = result
+        prev_limit = limit
+
+    result = calc_taxes(regime, mode, amount, expense_pct, wage_base, HIPA_RATE)
+    if result.revenue * 12 > prev_limit or fallback is None:
+        return result
+    return fallback
+
+
 def format_tax_result(r, regime, expense_pct, mode, input_amount, wage_base=None):
     """Форматирование результатов."""
     if wage_base is None:
@@ -263,106 +471,110 @@ def format_tax_result(r, regime, expense_pct, mode, input_amount, wage_base=None
     mode_names = {'revenue': 'оборота', 'net': 'чистой прибыли', 'tax': 'суммы налогов'}
     base_label = "гарант." if wage_base == GUAR_WAGE else "мін."
 
-    msg = f"🧮 <b>{names[regime]}</b>\n"
-    msg += f"Расчёт из {mode_names[mode]}: {fmt(input_amount)} Ft/мес\n"
+    parts = [f"🧮 <b>{names[regime]}</b>\n"]
+    parts.append(f"Расчёт из {mode_names[mode]}: {fmt(input_amount)} Ft/мес\n")
     if regime != 'kata' and expense_pct > 0:
-        msg += f"Расходы: {expense_pct}%\n"
+        parts.append(f"Расходы: {expense_pct}%\n")
     if regime != 'kata':
-        msg += f"Мін. база: {fmt(wage_base)} Ft ({base_label})\n"
-    msg += "\n"
+        parts.append(f"Мін. база: {fmt(wage_base)} Ft ({base_label})\n")
+    parts.append("\n")
 
-    is_kata = r.get('is_kata', False)
-    minimums = not is_kata and r['profit'] < wage_base
+    is_kata = r.is_kata
+    minimums = not is_kata and r.profit < wage_base
 
     # HIPA
-    rev_yr = r['revenue'] * 12
-    profit_yr = r['profit'] * 12
+    rev_yr = r.revenue * 12
+    profit_yr = r.profit * 12
     hipa_yr = calc_hipa_yearly(rev_yr, profit_yr)
     hipa_mo = hipa_yr / 12
     is_savos = rev_yr <= 25_000_000
     hipa_label = "sávos" if is_savos else "станд."
 
-    total_with_hipa = r['total_tax'] + hipa_mo
-    net_with_hipa = r['net'] - hipa_mo
+    total_with_hipa = r.total_tax + hipa_mo
+    net_with_hipa = r.net - hipa_mo
 
     # --- Месяц ---
-    msg += "\U0001f4c5 <b>В месяц:</b>\n"
-    msg += f"  Оборот (доход): <b>{fmt(r['revenue'])}</b> Ft\n"
-    if r['expenses'] > 0:
-        msg += f"  Расходы ({expense_pct}%): -{fmt(r['expenses'])} Ft\n"
-        msg += f"  Налог. база: {fmt(r['profit'])} Ft\n"
+    parts.append("\U0001f4c5 <b>В месяц:</b>\n")
+    parts.append(f"  Оборот (доход): <b>{fmt(r.revenue)}</b> Ft\n")
+    if r.expenses > 0:
+        parts.append(f"  Расходы ({expense_pct}%): -{fmt(r.expenses)} Ft\n")
+        parts.append(f"  Налог. база: {fmt(r.profit)} Ft\n")
 
-    msg += f"\n  Итого налоги: <b>-{fmt(total_with_hipa)} Ft</b>\n"
+    parts.append(f"\n  Итого налоги: <b>-{fmt(total_with_hipa)} Ft</b>\n")
 
     if is_kata:
-        msg += f"  KATA: -{fmt(r['kata'])} Ft\n"
-        if r.get('extra_tax', 0) > 0:
-            msg += f"  Доп. налог 40%: -{fmt(r['extra_tax'])} Ft\n"
+        parts.append(f"  KATA: -{fmt(r.kata)} Ft\n")
+        if r.extra_tax > 0:
+            parts.append(f"  Доп. налог 40%: -{fmt(r.extra_tax)} Ft\n")
     else:
-        szja_ex = r.get('szja_exempt', 0)
-        if szja_ex > 0 and r['szja'] == 0:
-            msg += f"  SZJA (15%): 0 Ft (льгота до {fmt(szja_ex)} Ft/мес)\n"
+        szja_ex = r.szja_exempt
+        if szja_ex > 0 and r.szja == 0:
+            parts.append(f"  SZJA (15%): 0 Ft (льгота до {fmt(szja_ex)} Ft/мес)\n")
         elif szja_ex > 0:
-            msg += f"  SZJA (15%): -{fmt(r['szja'])} Ft (льгота {fmt(szja_ex)} Ft/мес)\n"
+            parts.append(f"  SZJA (15%): -{fmt(r.szja)} Ft (льгота {fmt(szja_ex)} Ft/мес)\n")
         else:
-            msg += f"  SZJA (15%): -{fmt(r['szja'])} Ft\n"
+            parts.append(f"  SZJA (15%): -{fmt(r.szja)} Ft\n")
         sn = " \u26a1\u043c\u0438\u043d." if minimums else ""
-        msg += f"  SZOCHO (13%){sn}: -{fmt(r['szocho'])} Ft\n"
-        msg += f"  TB (18.5%){sn}: -{fmt(r['tb'])} Ft\n"
-    msg += f"  HIPA (2%, {hipa_label}): -{fmt(hipa_mo)} Ft\n"
+        parts.append(f"  SZOCHO (13%){sn}: -{fmt(r.szocho)} Ft\n")
+        parts.append(f"  TB (18.5%){sn}: -{fmt(r.tb)} Ft\n")
+    parts.append(f"  HIPA (2%, {hipa_label}): -{fmt(hipa_mo)} Ft\n")
 
-    msg += f"\n  Чистая прибыль: <b>{fmt(net_with_hipa)} Ft</b>\n"
-    if r['revenue'] > 0:
-        eff = total_with_hipa / r['revenue'] * 100
-        msg += f"  Эфф. ставка: {eff:.1f}%\n"
+    parts.append(f"\n  Чистая прибыль: <b>{fmt(net_with_hipa)} Ft</b>\n")
+    if r.revenue > 0:
+        eff = total_with_hipa / r.revenue * 100
+        parts.append(f"  Эфф. ставка: {eff:.1f}%\n")
 
     # --- Год ---
-    msg += f"\n\U0001f4c5 <b>В год:</b>\n"
-    msg += f"  Оборот: <b>{fmt(rev_yr)}</b> Ft\n"
-    if r['expenses'] > 0:
-        msg += f"  Расходы: -{fmt(r['expenses'] * 12)} Ft\n"
-    msg += f"  Налоги (вкл. HIPA {fmt(hipa_yr)} Ft): <b>-{fmt(total_with_hipa * 12)} Ft</b>\n"
-    msg += f"  Чистая: <b>{fmt(net_with_hipa * 12)} Ft</b>\n"
+    parts.append(f"\n\U0001f4c5 <b>В год:</b>\n")
+    parts.append(f"  Оборот: <b>{fmt(rev_yr)}</b> Ft\n")
+    if r.expenses > 0:
+        parts.append(f"  Расходы: -{fmt(r.expenses * 12)} Ft\n")
+    parts.append(f"  Налоги (вкл. HIPA {fmt(hipa_yr)} Ft): <b>-{fmt(total_with_hipa * 12)} Ft</b>\n")
+    parts.append(f"  Чистая: <b>{fmt(net_with_hipa * 12)} Ft</b>\n")
 
     # Предупреждения
     if net_with_hipa < 0:
-        msg += "\n⚠️ Чистая прибыль отрицательная!\n"
+        parts.append("\n⚠️ Чистая прибыль отрицательная!\n")
     if minimums:
-        msg += f"\n⚡ Минимальные взносы (база &lt; {fmt(wage_base)} Ft)\n"
+        parts.append(f"\n⚡ Минимальные взносы (база &lt; {fmt(wage_base)} Ft)\n")
     if is_kata and rev_yr > KATA_LIMIT:
-        msg += f"\n⚠️ Превышен лимит KATA ({fmt(KATA_LIMIT)} Ft/год)\n"
+        parts.append(f"\n⚠️ Превышен лимит KATA ({fmt(KATA_LIMIT)} Ft/год)\n")
     if regime == 'atalany' and rev_yr > ATALANY_LIMIT:
-        msg += (f"\n⚠️ Оборот {fmt(rev_yr)} Ft/год превышает лимит "
-                f"Átalányadó ({fmt(ATALANY_LIMIT)} Ft/год)!\n"
-                "Необходимо перейти на стандартный EV.\n")
+        parts.append(f"\n⚠️ Оборот {fmt(rev_yr)} Ft/год превышает лимит "
+                     f"Átalányadó ({fmt(ATALANY_LIMIT)} Ft/год)!\n"
+                     "Необходимо перейти на стандартный EV.\n")
     if not is_kata and rev_yr > AFA_EXEMPT_LIMIT:
-        msg += (f"\n⚠️ Оборот превышает {fmt(AFA_EXEMPT_LIMIT)} Ft/год — "
-                "необходима регистрация плательщиком ÁFA (27%).\n"
-                "Подробнее: /vat\n")
+        parts.append(f"\n⚠️ Оборот превышает {fmt(AFA_EXEMPT_LIMIT)} Ft/год — "
+                     "необходима регистрация плательщиком ÁFA (27%).\n"
+                     "Подробнее: /vat\n")
     elif not is_kata and rev_yr > 0:
-        msg += (f"\n✅ Оборот в пределах {fmt(AFA_EXEMPT_LIMIT)} Ft/год — "
-                "можно использовать освобождение от ÁFA (alanyi mentesség).\n")
+        parts.append(f"\n✅ Оборот в пределах {fmt(AFA_EXEMPT_LIMIT)} Ft/год — "
+                     "можно использовать освобождение от ÁFA (alanyi mentesség).\n")
 
     # Проверка требований миграционки (ВНЖ)
     net_yr = net_with_hipa * 12
     if net_yr > 0:
         if net_yr >= MIGR_GUAR:
-            msg += (f"\n✅ Чистая прибыль соответствует требованиям миграционки "
-                    f"({fmt(net_yr)} &gt; {fmt(MIGR_GUAR)} Ft/год)\n")
+            parts.append(f"\n✅ Чистая прибыль соответствует требованиям миграционки "
+                         f"({fmt(net_yr)} &gt; {fmt(MIGR_GUAR)} Ft/год)\n")
         elif net_yr >= MIGR_MIN:
-            msg += (f"\n⚠️ Чистая прибыль соответствует минимальному порогу "
-                    f"({fmt(net_yr)} &gt; {fmt(MIGR_MIN)} Ft/год), "
-                    f"но ниже рекомендуемого ({fmt(MIGR_GUAR)} Ft/год)\n")
+            parts.append(f"\n⚠️ Чистая прибыль соответствует минимальному порогу "
+                         f"({fmt(net_yr)} &gt; {fmt(MIGR_MIN)} Ft/год), "
+                         f"но ниже рекомендуемого ({fmt(MIGR_GUAR)} Ft/год)\n")
         else:
-            msg += (f"\n❌ Чистая прибыль ниже требований миграционки "
-                    f"({fmt(net_yr)} &lt; {fmt(MIGR_MIN)} Ft/год)\n")
-        msg += "Подробнее: /vnzh\n"
+            parts.append(f"\n❌ Чистая прибыль ниже требований миграционки "
+                         f"({fmt(net_yr)} &lt; {fmt(MIGR_MIN)} Ft/год)\n")
+        parts.append("Подробнее: /vnzh\n")
 
-    return msg
+    return "".join(parts)
 
 
 # === ОБРАБОТЧИКИ TELEGRAM ===
 
+# Тексты справочных команд статичны — собираем их один раз при импорте
+_SEP = "━━━━━━━━━━━━━━━━━━━━━"
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
     u = update.effective_user
@@ -384,242 +596,284 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+_RATES_TEXT = (
+    "📊 <b>Ставки налогов 2026</b>\n\n"
+    #
+    f"{_SEP}\n"
+    f"<b>SZJA — подоходный налог: {SZJA_RATE:.0%}</b>\n"
+    "Считается от прибыли (доход − расходы).\n"
+    "Для Átalányadó — от прибыли после вычета "
+    "нормы расходов (45/80/90%).\n\n"
+    #
+    f"{_SEP}\n"
+    f"<b>SZOCHO — соц. взнос: {SZOCHO_RATE:.0%}</b>\n"
+    "Считается от той же базы, что и SZJA.\n"
+    "Но не менее минималки (см. ниже).\n\n"
+    #
+    f"{_SEP}\n"
+    f"<b>TB — соц. страхование: {TB_RATE:.1%}</b>\n"
+    "Считается от той же базы, что и SZJA.\n"
+    "Но не менее минималки (см. ниже).\n\n"
+    #
+    f"{_SEP}\n"
+    f"<b>Итого SZJA + SZOCHO + TB: {TOTAL_TAX_RATE:.1%}</b>\n"
+    "Применяется к прибыли. Если прибыль ниже "
+    "минималки — взносы считаются от минималки.\n\n"
+    #
+    f"{_SEP}\n"
+    "<b>Минимальная база (минималка)</b>\n"
+    f"  {fmt(MIN_WAGE)} Ft/мес\n"
+    f"  Мин. взносы SZOCHO+TB: {fmt(_WAGE_CONSTS[MIN_WAGE, 0].min_social)} Ft/мес\n"
+    "Если прибыль за месяц ниже минималки, "
+    "SZOCHO и TB всё равно платятся от неё.\n\n"
+    #
+    f"{_SEP}\n"
+    "<b>Гарантированная минималка</b>\n"
+    f"  {fmt(GUAR_WAGE)} Ft/мес\n"
+    f"  Мин. взносы SZOCHO+TB: {fmt(_WAGE_CONSTS[GUAR_WAGE, 0].min_social)} Ft/мес\n"
+    "Для квалифицированной деятельности "
+    "(средне-спец. или высшее образование).\n\n"
+    #
+    f"{_SEP}\n"
+    f"<b>KATA: {fmt(KATA_MONTHLY)} Ft/мес</b>\n"
+    f"Фиксированный налог. Лимит дохода: {fmt(KATA_LIMIT)} Ft/год.\n"
+    "Превышение лимита — доплата 40% с суммы сверх.\n\n"
+    #
+    f"{_SEP}\n"
+    f"<b>HIPA — местный налог (Будапешт): {HIPA_RATE:.0%}</b>\n"
+    "Считается от прибыли. В Будапеште — "
+    "упрощённые пороги (sávos):\n"
+    "  до 12M Ft → 50 000 Ft/год\n"
+    "  12–18M Ft → 120 000 Ft/год\n"
+    "  18–25M Ft → 170 000 Ft/год\n"
+    "  &gt;25M Ft → прибыль × 2%\n"
+    "В других городах ставка может отличаться.\n\n"
+    "📩 Консультация: @HungaryVisaShop"
+)
+_RATES_MSG = {'text': _RATES_TEXT, 'parse_mode': 'HTML'}
+
+
 async def show_rates(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /rates — показать ставки"""
-    min_total = MIN_WAGE * (SZOCHO_RATE + TB_RATE)
-    guar_total = GUAR_WAGE * (SZOCHO_RATE + TB_RATE)
-    sep = "━━━━━━━━━━━━━━━━━━━━━"
-
-    await update.message.reply_text(
-        "📊 <b>Ставки налогов 2026</b>\n\n"
-        #
-        f"{sep}\n"
-        f"<b>SZJA — подоходный налог: {SZJA_RATE:.0%}</b>\n"
-        "Считается от прибыли (доход − расходы).\n"
-        "Для Átalányadó — от прибыли после вычета "
-        "нормы расходов (45/80/90%).\n\n"
-        #
-        f"{sep}\n"
-        f"<b>SZOCHO — соц. взнос: {SZOCHO_RATE:.0%}</b>\n"
-        "Считается от той же базы, что и SZJA.\n"
-        "Но не менее минималки (см. ниже).\n\n"
-        #
-        f"{sep}\n"
-        f"<b>TB — соц. страхование: {TB_RATE:.1%}</b>\n"
-        "Считается от той же базы, что и SZJA.\n"
-        "Но не менее минималки (см. ниже).\n\n"
-        #
-        f"{sep}\n"
-        f"<b>Итого SZJA + SZOCHO + TB: {TOTAL_TAX_RATE:.1%}</b>\n"
-        "Применяется к прибыли. Если прибыль ниже "
-        "минималки — взносы считаются от минималки.\n\n"
-        #
-        f"{sep}\n"
-        "<b>Минимальная база (минималка)</b>\n"
-        f"  {fmt(MIN_WAGE)} Ft/мес\n"
-        f"  Мин. взносы SZOCHO+TB: {fmt(min_total)} Ft/мес\n"
-        "Если прибыль за месяц ниже минималки, "
-        "SZOCHO и TB всё равно платятся от неё.\n\n"
-        #
-        f"{sep}\n"
-        "<b>Гарантированная минималка</b>\n"
-        f"  {fmt(GUAR_WAGE)} Ft/мес\n"
-        f"  Мин. взносы SZOCHO+TB: {fmt(guar_total)} Ft/мес\n"
-        "Для квалифицированной деятельности "
-        "(средне-спец. или высшее образование).\n\n"
-        #
-        f"{sep}\n"
-        f"<b>KATA: {fmt(KATA_MONTHLY)} Ft/мес</b>\n"
-        f"Фиксированный налог. Лимит дохода: {fmt(KATA_LIMIT)} Ft/год.\n"
-        "Превышение лимита — доплата 40% с суммы сверх.\n\n"
-        #
-        f"{sep}\n"
-        f"<b>HIPA — местный налог (Будапешт): {HIPA_RATE:.0%}</b>\n"
-        "Считается от прибыли. В Будапеште — "
-        "упрощённые пороги (sávos):\n"
-        "  до 12M Ft → 50 000 Ft/год\n"
-        "  12–18M Ft → 120 000 Ft/год\n"
-        "  18–25M Ft → 170 000 Ft/год\n"
-        "  &gt;25M Ft → прибыль × 2%\n"
-        "В других городах ставка может отличаться.\n\n"
-        "📩 Консультация: @HungaryVisaShop",
-        parse_mode='HTML',
-    )
+    await update.message.reply_text(**_RATES_MSG)
+
+
+_REGIMES_TEXT = (
+    "📋 <b>Режимы налогообложения ИП (2026)</b>\n\n"
+    "<b>KATA</b> — упрощённый фикс. налог\n\n"
+    "  Клиенты: только физлица и не связ. лица\n"
+    "  Для кого: фрилансеры (beauty мастера, репетиторы, фотографы и т.д.)\n\n"
+    f"  Налог: {fmt(KATA_MONTHLY)} Ft/мес (фикс.)\n"
+    f"  Лимит: {fmt(KATA_LIMIT)} Ft/год\n"
+    f"  Если оборот больше {fmt(KATA_LIMIT)} Ft/год —\n"
+    "  налог 40% с суммы превышения\n\n"
+    "  Преимущества:\n"
+    "  Нет SZJA, SZOCHO, TB\n"
+    "  Нет ÁFA (VAT)\n"
+    "  Доступ к бесплатным гос. мед. услугам\n"
+    "  Простые счета, не нужен бухгалтер на постоянной основе\n\n"
+    "  Не подходит для IT-аутсорса на одну компанию\n"
+    "  или работы с крупным заказчиком\n"
+    "  Сотрудники: нельзя нанимать\n\n"
+    "━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
+    "<b>Átalányadó</b> — нормативные расходы\n\n"
+    "  Клиенты: любые (🇭🇺 🇪🇺 🌍), без ограничений\n"
+    "  Для кого: IT, консалтинг, услуги с малыми расходами\n\n"
+    "  Налоги: SZJA 15% + SZOCHO 13% + TB 18.5%\n"
+    "  Норма расходов: 45%, 80% или 90% (с 2027 — 50%)\n"
+    f"  Льгота SZJA: первые {fmt(SZJA_EXEMPT)} Ft/год не облагаются\n"
+    f"  Лимит: {fmt(ATALANY_LIMIT)} Ft/год\n"
+    "  При превышении — переход на стандартный EV\n\n"
+    "  Преимущества:\n"
+    "  Самый популярный режим для IT-фрилансеров\n"
+    "  Не нужно подтверждать расходы\n"
+    "  Льгота SZJA экономит ~290 000 Ft/год\n"
+    "  Работа с любыми клиентами по всему миру\n\n"
+    "  Сотрудники: можно, но невыгодно (расходы не вычитаются)\n\n"
+    "━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
+    "<b>Стандартный EV</b> — по факт. расходам\n\n"
+    "  Клиенты: любые (🇭🇺 🇪🇺 🌍), без ограничений\n"
+    "  Для кого: торговля, производство, большие обороты\n\n"
+    "  Налоги: SZJA 15% + SZOCHO 13% + TB 18.5%\n"
+    "  Расходы: фактические (подтверждённые документами)\n"
+    "  Без лимита оборота\n"
+    "  Без льготы SZJA\n\n"
+    "  Преимущества:\n"
+    "  Нет ограничения по обороту\n"
+    "  Все расходы уменьшают налог. базу\n"
+    "  Можно нанимать сотрудников (зарплаты = расходы)\n\n"
+    "  Нужен бухгалтер и подтверждение расходов\n\n"
+    "━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
+    "Все режимы: + HIPA (местный налог, Будапешт 2%)\n"
+    "Подробнее: /rates — ставки, /vat — ÁFA\n\n"
+    "📩 Консультация: @HungaryVisaShop"
+)
+_REGIMES_MSG = {'text': _REGIMES_TEXT, 'parse_mode': 'HTML'}
 
 
 async def show_regimes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /regimes — справочник по режимам"""
-    await update.message.reply_text(
-        "📋 <b>Режимы налогообложения ИП (2026)</b>\n\n"
-        "<b>KATA</b> — упрощённый фикс. налог\n\n"
-        "  Клиенты: только физлица и не связ. лица\n"
-        "  Для кого: фрилансеры (beauty мастера, репетиторы, фотографы и т.д.)\n\n"
-        f"  Налог: {fmt(KATA_MONTHLY)} Ft/мес (фикс.)\n"
-        f"  Лимит: {fmt(KATA_LIMIT)} Ft/год\n"
-        f"  Если оборот больше {fmt(KATA_LIMIT)} Ft/год —\n"
-        "  налог 40% с суммы превышения\n\n"
-        "  Преимущества:\n"
-        "  Нет SZJA, SZOCHO, TB\n"
-        "  Нет ÁFA (VAT)\n"
-        "  Доступ к бесплатным гос. мед. услугам\n"
-        "  Простые счета, не нужен бухгалтер на постоянной основе\n\n"
-        "  Не подходит для IT-аутсорса на одну компанию\n"
-        "  или работы с крупным заказчиком\n"
-        "  Сотрудники: нельзя нанимать\n\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        "<b>Átalányadó</b> — нормативные расходы\n\n"
-        "  Клиенты: любые (🇭🇺 🇪🇺 🌍), без ограничений\n"
-        "  Для кого: IT, консалтинг, услуги с малыми расходами\n\n"
-        "  Налоги: SZJA 15% + SZOCHO 13% + TB 18.5%\n"
-        "  Норма расходов: 45%, 80% или 90% (с 2027 — 50%)\n"
-        f"  Льгота SZJA: первые {fmt(SZJA_EXEMPT)} Ft/год не облагаются\n"
-        f"  Лимит: {fmt(ATALANY_LIMIT)} Ft/год\n"
-        "  При превышении — переход на стандартный EV\n\n"
-        "  Преимущества:\n"
-        "  Самый популярный режим для IT-фрилансеров\n"
-        "  Не нужно подтверждать расходы\n"
-        "  Льгота SZJA экономит ~290 000 Ft/год\n"
-        "  Работа с любыми клиентами по всему миру\n\n"
-        "  Сотрудники: можно, но невыгодно (расходы не вычитаются)\n\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        "<b>Стандартный EV</b> — по факт. расходам\n\n"
-        "  Клиенты: любые (🇭🇺 🇪🇺 🌍), без ограничений\n"
-        "  Для кого: торговля, производство, большие обороты\n\n"
-        "  Налоги: SZJA 15% + SZOCHO 13% + TB 18.5%\n"
-        "  Расходы: фактические (подтверждённые документами)\n"
-        "  Без лимита оборота\n"
-        "  Без льготы SZJA\n\n"
-        "  Преимущества:\n"
-        "  Нет ограничения по обороту\n"
-        "  Все расходы уменьшают налог. базу\n"
-        "  Можно нанимать сотрудников (зарплаты = расходы)\n\n"
-        "  Нужен бухгалтер и подтверждение расходов\n\n"
-        "━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        "Все режимы: + HIPA (местный налог, Будапешт 2%)\n"
-        "Подробнее: /rates — ставки, /vat — ÁFA\n\n"
-        "📩 Консультация: @HungaryVisaShop",
-        parse_mode='HTML',
-    )
+    await update.message.reply_text(**_REGIMES_MSG)
+
+
+_VAT_TEXT = (
+    "📋 <b>ÁFA (НДС) для ИП — 2026</b>\n\n"
+    "<b>Ставки:</b>\n"
+    "  27% — стандартная\n"
+    "  18% — продукты питания, общепит\n"
+    "  5% — книги, лекарства, жильё\n\n"
+    f"<b>Порог освобождения (alanyi mentesség):</b>\n"
+    f"  2026: {fmt(AFA_EXEMPT_LIMIT)} Ft/год\n"
+    "  2027: 22 000 000 Ft/год\n"
+    "  2028: 24 000 000 Ft/год\n\n"
+    "Если оборот ≤ порога — можно не начислять ÁFA.\n"
+    "Если превышен — обязательная регистрация.\n\n"
+    "<b>Кому начисляется ÁFA (если вы плательщик):</b>\n"
+    "  🇭🇺 Клиент в Венгрии → 27%\n"
+    "  🇪🇺 ЕС, B2B (есть EU VAT ID) → 0% (reverse charge)\n"
+    "  🇪🇺 ЕС, B2C → 27% (венгерский ÁFA)\n"
+    "  🌍 Вне ЕС → 0%\n\n"
+    "⚠️ KATA-плательщики автоматически освобождены от ÁFA.\n\n"
+    "📩 Консультация: @HungaryVisaShop"
+)
+_VAT_MSG = {'text': _VAT_TEXT, 'parse_mode': 'HTML'}
 
 
 async def show_vat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /vat — справочник ÁFA"""
-    await update.message.reply_text(
-        "📋 <b>ÁFA (НДС) для ИП — 2026</b>\n\n"
-        "<b>Ставки:</b>\n"
-        "  27% — стандартная\n"
-        "  18% — продукты питания, общепит\n"
-        "  5% — книги, лекарства, жильё\n\n"
-        f"<b>Порог освобождения (alanyi mentesség):</b>\n"
-        f"  2026: {fmt(AFA_EXEMPT_LIMIT)} Ft/год\n"
-        "  2027: 22 000 000 Ft/год\n"
-        "  2028: 24 000 000 Ft/год\n\n"
-        "Если оборот ≤ порога — можно не начислять ÁFA.\n"
-        "Если превышен — обязательная регистрация.\n\n"
-        "<b>Кому начисляется ÁFA (если вы плательщик):</b>\n"
-        "  🇭🇺 Клиент в Венгрии → 27%\n"
-        "  🇪🇺 ЕС, B2B (есть EU VAT ID) → 0% (reverse charge)\n"
-        "  🇪🇺 ЕС, B2C → 27% (венгерский ÁFA)\n"
-        "  🌍 Вне ЕС → 0%\n\n"
-        "⚠️ KATA-плательщики автоматически освобождены от ÁFA.\n\n"
-        "📩 Консультация: @HungaryVisaShop",
-        parse_mode='HTML',
-    )
+    await update.message.reply_text(**_VAT_MSG)
+
+
+_VNZH_TEXT = (
+    "🏛 <b>Требования к доходу ИП для продления ВНЖ</b>\n\n"
+    f"{_SEP}\n"
+    "<b>Закон:</b> 2024. évi XXXV. törvény, §12 (4)\n\n"
+    "Формулировка: годовой доход ИП должен превышать "
+    "24-кратный размер минимальной зарплаты "
+    "(minimálbér).\n\n"
+    "<i>«az egyéni vállalkozásból származó éves "
+    "jövedelem meghaladja a mindenkori minimálbér "
+    "huszonnégyszeresét»</i>\n\n"
+    #
+    f"{_SEP}\n"
+    f"<b>Минимальный порог (по закону):</b>\n"
+    f"  minimálbér × 24 = {fmt(MIGR_MIN)} Ft/год\n"
+    f"  ({fmt(MIN_WAGE)} × 24)\n\n"
+    #
+    f"{_SEP}\n"
+    f"<b>Рекомендуемый порог:</b>\n"
+    f"  garantált bérminimum × 24 = {fmt(MIGR_GUAR)} Ft/год\n"
+    f"  ({fmt(GUAR_WAGE)} × 24)\n\n"
+    "В законе указан minimálbér, но мы рекомендуем "
+    "ориентироваться на garantált bérminimum "
+    "(квалифицированная минималка), особенно если "
+    "ваша деятельность требует квалификации — "
+    "миграционная служба может ориентироваться "
+    "на него при оценке дохода.\n\n"
+    #
+    f"{_SEP}\n"
+    "<b>Дополнительно:</b>\n"
+    "• ИП должен быть активен (не приостановлен)\n"
+    "• Налоговая отчётность сдана\n"
+    "• Нет задолженности по налогам (NAV)\n\n"
+    "📩 Консультация: @HungaryVisaShop"
+)
+_VNZH_MSG = {'text': _VNZH_TEXT, 'parse_mode': 'HTML'}
 
 
 async def show_vnzh(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /vnzh — требования миграционки к доходу ИП"""
-    sep = "━━━━━━━━━━━━━━━━━━━━━"
-
-    await update.message.reply_text(
-        "🏛 <b>Требования к доходу ИП для продления ВНЖ</b>\n\n"
-        f"{sep}\n"
-        "<b>Закон:</b> 2024. évi XXXV. törvény, §12 (4)\n\n"
-        "Формулировка: годовой доход ИП должен превышать "
-        "24-кратный размер минимальной зарплаты "
-        "(minimálbér).\n\n"
-        "<i>«az egyéni vállalkozásból származó éves "
-        "jövedelem meghaladja a mindenkori minimálbér "
-        "huszonnégyszeresét»</i>\n\n"
-        #
-        f"{sep}\n"
-        f"<b>Минимальный порог (по закону):</b>\n"
-        f"  minimálbér × 24 = {fmt(MIGR_MIN)} Ft/год\n"
-        f"  ({fmt(MIN_WAGE)} × 24)\n\n"
-        #
-        f"{sep}\n"
-        f"<b>Рекомендуемый порог:</b>\n"
-        f"  garantált bérminimum × 24 = {fmt(MIGR_GUAR)} Ft/год\n"
-        f"  ({fmt(GUAR_WAGE)} × 24)\n\n"
-        "В законе указан minimálbér, но мы рекомендуем "
-        "ориентироваться на garantált bérminimum "
-        "(квалифицированная минималка), особенно если "
-        "ваша деятельность требует квалификации — "
-        "миграционная служба может ориентироваться "
-        "на него при оценке дохода.\n\n"
-        #
-        f"{sep}\n"
-        "<b>Дополнительно:</b>\n"
-        "• ИП должен быть активен (не приостановлен)\n"
-        "• Налоговая отчётность сдана\n"
-        "• Нет задолженности по налогам (NAV)\n\n"
-        "📩 Консультация: @HungaryVisaShop",
-        parse_mode='HTML',
-    )
+    await update.message.reply_text(**_VNZH_MSG)
+
+
+_MROT_TEXT = (
+    "💰 <b>МРОТ (минимальная зарплата) — 2026</b>\n\n"
+    "МРОТ определяет минимальную базу для расчёта "
+    "взносов SZOCHO и TB. Даже если прибыль ниже — "
+    "взносы платятся от МРОТ.\n\n"
+    #
+    f"{_SEP}\n"
+    f"<b>Минималка: {fmt(MIN_WAGE)} Ft/мес</b>\n"
+    f"Мин. взносы SZOCHO+TB: {fmt(_WAGE_CONSTS[MIN_WAGE, 0].min_social)} Ft/мес\n\n"
+    "Применяется, если деятельность <b>не требует</b> "
+    "квалификации (специального образования).\n\n"
+    "Примеры: уборка, курьер, торговля, "
+    "beauty-услуги без спец. диплома.\n\n"
+    #
+    f"{_SEP}\n"
+    f"<b>Гарантированная минималка: {fmt(GUAR_WAGE)} Ft/мес</b>\n"
+    f"Мин. взносы SZOCHO+TB: {fmt(_WAGE_CONSTS[GUAR_WAGE, 0].min_social)} Ft/мес\n\n"
+    "Применяется, если деятельность <b>требует</b> "
+    "средне-специального или высшего образования.\n\n"
+    "Примеры: IT-разработка, дизайн, бухгалтерия, "
+    "юридические услуги, медицина, инженерия.\n\n"
+    #
+    f"{_SEP}\n"
+    "<b>Как это влияет на налоги?</b>\n\n"
+    "Если ваша прибыль за месяц ниже МРОТ — "
+    "взносы SZOCHO и TB всё равно считаются от МРОТ.\n"
+    "SZJA считается от фактической прибыли (может быть 0).\n\n"
+    "Выбор МРОТ влияет только на Átalányadó и "
+    "Стандартный EV. Для KATA — не применяется.\n\n"
+    "📩 Консультация: @HungaryVisaShop"
+)
+_MROT_MSG = {'text': _MROT_TEXT, 'parse_mode': 'HTML'}
 
 
 async def show_mrot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /mrot — справочник по МРОТ"""
-    min_total = MIN_WAGE * (SZOCHO_RATE + TB_RATE)
-    guar_total = GUAR_WAGE * (SZOCHO_RATE + TB_RATE)
-    sep = "━━━━━━━━━━━━━━━━━━━━━"
-
-    await update.message.reply_text(
-        "💰 <b>МРОТ (минимальная зарплата) — 2026</b>\n\n"
-        "МРОТ определяет минимальную базу для расчёта "
-        "взносов SZOCHO и TB. Даже если прибыль ниже — "
-        "взносы платятся от МРОТ.\n\n"
-        #
-        f"{sep}\n"
-        f"<b>Минималка: {fmt(MIN_WAGE)} Ft/мес</b>\n"
-        f"Мин. взносы SZOCHO+TB: {fmt(min_total)} Ft/мес\n\n"
-        "Применяется, если деятельность <b>не требует</b> "
-        "квалификации (специального образования).\n\n"
-        "Примеры: уборка, курьер, торговля, "
-        "beauty-услуги без спец. диплома.\n\n"
-        #
-        f"{sep}\n"
-        f"<b>Гарантированная минималка: {fmt(GUAR_WAGE)} Ft/мес</b>\n"
-        f"Мин. взносы SZOCHO+TB: {fmt(guar_total)} Ft/мес\n\n"
-        "Применяется, если деятельность <b>требует</b> "
-        "средне-специального или высшего образования.\n\n"
-        "Примеры: IT-разработка, дизайн, бухгалтерия, "
-        "юридические услуги, медицина, инженерия.\n\n"
-        #
-        f"{sep}\n"
-        "<b>Как это влияет на налоги?</b>\n\n"
-        "Если ваша прибыль за месяц ниже МРОТ — "
-        "взносы SZOCHO и TB всё равно считаются от МРОТ.\n"
-        "SZJA считается от фактической прибыли (может быть 0).\n\n"
-        "Выбор МРОТ влияет только на Átalányadó и "
-        "Стандартный EV. Для KATA — не применяется.\n\n"
-        "📩 Консультация: @HungaryVisaShop",
-        parse_mode='HTML',
-    )
+    await update.message.reply_text(**_MROT_MSG)
+
+
+# Клавиатуры одинаковы для всех пользователей (и неизменяемы) — создаём один раз
+_KB_REGIME = InlineKeyboardMarkup([
+    [InlineKeyboardButton("KATA", callback_data="tax_r:kata")],
+    [InlineKeyboardButton("Átalányadó", callback_data="tax_r:atalany")],
+    [InlineKeyboardButton("Стандартный EV", callback_data="tax_r:standard")],
+])
+
+_KB_COST = InlineKeyboardMarkup([[
+    InlineKeyboardButton("45%", callback_data="tax_c:45"),
+    InlineKeyboardButton("80%", callback_data="tax_c:80"),
+    InlineKeyboardButton("90%", callback_data="tax_c:90"),
+]])
+
+# База мин. взносов
+_KB_WAGE = InlineKeyboardMarkup([
+    [InlineKeyboardButton(
+        f"Да — МРОТ {fmt(GUAR_WAGE)} Ft",
+        callback_data="tax_w:guar")],
+    [InlineKeyboardButton(
+        f"Нет — МРОТ {fmt(MIN_WAGE)} Ft",
+        callback_data="tax_w:min")],
+])
+
+_KB_MODE_KATA = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Знаю оборот (выручку)", callback_data="tax_m:revenue")],
+    [InlineKeyboardButton("Знаю чистую прибыль", callback_data="tax_m:net")],
+])
+
+_KB_MODE_ALL = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Знаю оборот (выручку)", callback_data="tax_m:revenue")],
+    [InlineKeyboardButton("Знаю чистую прибыль", callback_data="tax_m:net")],
+    [InlineKeyboardButton("Знаю сумму налогов", callback_data="tax_m:tax")],
+])
+
+# Шаблоны callback_data кнопок — компилируются один раз
+_PAT_R = re.compile(r'^tax_r:')
+_PAT_C = re.compile(r'^tax_c:')
+_PAT_W = re.compile(r'^tax_w:')
+_PAT_M = re.compile(r'^tax_m:')
 
 
 async def tax_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """/tax — начало расчёта"""
-    keyboard = [
-        [InlineKeyboardButton("KATA", callback_data="tax_r:kata")],
-        [InlineKeyboardButton("Átalányadó", callback_data="tax_r:atalany")],
-        [InlineKeyboardButton("Стандартный EV", callback_data="tax_r:standard")],
-    ]
+    context.user_data['s'] = TaxSession()
     await update.message.reply_text(
         "🧮 <b>Калькулятор налогов ИП</b>\n\n"
         "Выберите режим:\n"
         "Не знаете какой? Посмотрите описание /regimes",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_KB_REGIME,
         parse_mode='HTML',
     )
     return TAX_REGIME
@@ -630,7 +884,7 @@ async def tax_regime_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     regime = query.data.split(":")[1]
-    context.user_data['tax_regime'] = regime
+    context.user_data['s'].regime = regime
 
     if regime == 'standard':
         await query.edit_message_text(
@@ -642,105 +896,93 @@ async def tax_regime_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return TAX_EXPENSES
 
     elif regime == 'atalany':
-        keyboard = [[
-            InlineKeyboardButton("45%", callback_data="tax_c:45"),
-            InlineKeyboardButton("80%", callback_data="tax_c:80"),
-            InlineKeyboardButton("90%", callback_data="tax_c:90"),
-        ]]
         await query.edit_message_text(
             "📊 <b>Átalányadó</b>\n"
             "Налоги на (оборот − норма расходов)\n\n"
             "Выберите норму расходов:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=_KB_COST,
             parse_mode='HTML',
         )
         return TAX_COST_RATIO
 
     else:  # kata
-        context.user_data['tax_expense_pct'] = 0
-        keyboard = [
-            [InlineKeyboardButton("Знаю оборот (выручку)", callback_data="tax_m:revenue")],
-            [InlineKeyboardButton("Знаю чистую прибыль", callback_data="tax_m:net")],
-        ]
+        context.user_data['s'].expense_pct = 0
         await query.edit_message_text(
             "📊 <b>KATA</b>\n"
             f"Фикс. налог: {fmt(KATA_MONTHLY)} Ft/мес\n"
             f"Лимит: {fmt(KATA_LIMIT)} Ft/год (сверх +40%)\n\n"
             "Что известно?",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=_KB_MODE_KATA,
             parse_mode='HTML',
         )
         return TAX_INPUT_MODE
 
 
-def _wage_base_keyboard():
-    """Кнопки выбора базы мин. взносов"""
-    return [
-        [InlineKeyboardButton(
-            f"Да — МРОТ {fmt(GUAR_WAGE)} Ft",
-            callback_data="tax_w:guar")],
-        [InlineKeyboardButton(
-            f"Нет — МРОТ {fmt(MIN_WAGE)} Ft",
-            callback_data="tax_w:min")],
-    ]
-
-
 async def tax_cost_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Норма расходов (Átalányadó)"""
     query = update.callback_query
     await query.answer()
     ratio = int(query.data.split(":")[1])
-    context.user_data['tax_expense_pct'] = ratio
+    context.user_data['s'].expense_pct = ratio
 
     await query.edit_message_text(
         f"📊 <b>Átalányadó</b> (норма расходов {ratio}%)\n\n"
         "Деятельность требует квалификации?\n"
         "Не уверены? Смотрите /mrot",
-        reply_markup=InlineKeyboardMarkup(_wage_base_keyboard()),
+        reply_markup=_KB_WAGE,
         parse_mode='HTML',
     )
     return TAX_WAGE_BASE
 
 
+# "30,5 %" → "30.5"
+_PERCENT_INPUT_TABLE = str.maketrans({'%': None, ',': '.', ' ': None})
+# До обработчика доходят только сообщения с цифрами и символами, которые разбор
+# ниже умеет отбросить или понять (знак, экспонента, '%'); остальным — сразу подсказка
+_PERCENT_FILTER = filters.Regex(re.compile(r'^(?=.*\d)[\s\d.,%+\-_eE]+$'))
+_PERCENT_HINT = "Введите число (например: 30):"
+
+
 async def tax_expenses_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ввод % расходов (Стандартный EV)"""
-    text = update.message.text.strip().replace('%', '').replace(',', '.').replace(' ', '')
+    text = update.message.text.translate(_PERCENT_INPUT_TABLE)
     try:
         pct = float(text)
         if pct < 0 or pct >= 100:
             await update.message.reply_text("Введите число от 0 до 99:")
             return TAX_EXPENSES
     except ValueError:
-        await update.message.reply_text("Введите число (например: 30):")
+        await update.message.reply_text(_PERCENT_HINT)
         return TAX_EXPENSES
 
-    context.user_data['tax_expense_pct'] = pct
+    context.user_data['s'].expense_pct = pct
 
     await update.message.reply_text(
         f"📊 <b>Стандартный EV</b> (расходы {pct:.0f}%)\n\n"
         "Деятельность требует квалификации?\n"
         "Не уверены? Смотрите /mrot",
-        reply_markup=InlineKeyboardMarkup(_wage_base_keyboard()),
+        reply_markup=_KB_WAGE,
         parse_mode='HTML',
     )
     return TAX_WAGE_BASE
 
 
+async def tax_expenses_invalid(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Не число вместо % расходов"""
+    await update.message.reply_text(_PERCENT_HINT)
+    return TAX_EXPENSES
+
+
 async def tax_wage_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Выбор базы мин. взносов"""
     query = update.callback_query
     await query.answer()
     choice = query.data.split(":")[1]
-    context.user_data['tax_wage_base'] = GUAR_WAGE if choice == 'guar' else MIN_WAGE
+    context.user_data['s'].wage_base = GUAR_WAGE if choice == 'guar' else MIN_WAGE
 
-    keyboard = [
-        [InlineKeyboardButton("Знаю оборот (выручку)", callback_data="tax_m:revenue")],
-        [InlineKeyboardButton("Знаю чистую прибыль", callback_data="tax_m:net")],
-        [InlineKeyboardButton("Знаю сумму налогов", callback_data="tax_m:tax")],
-    ]
     await query.edit_message_text(
         "Что известно?",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_KB_MODE_ALL,
     )
     return TAX_INPUT_MODE
 
@@ -750,7 +992,7 @@ async def tax_mode_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     mode = query.data.split(":")[1]
-    context.user_data['tax_mode'] = mode
+    context.user_data['s'].mode = mode
 
     prompts = {
         'revenue': '💰 Введите месячный оборот в Ft:',
@@ -761,41 +1003,35 @@ async def tax_mode_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return TAX_NUMBER
 
 
+# "1 000 000 Ft" / "1,000,000 huf" → "1000000"
+_NUMBER_INPUT_TABLE = str.maketrans(dict.fromkeys('fthu \xa0,'))
+# То же для суммы: буквы f/t/h/u (Ft, HUF) разбор выбрасывает в любом месте
+_NUMBER_FILTER = filters.Regex(re.compile(r'^(?=.*\d)[\s\d.,+\-_eEfFtThHuU]+$'))
+_NUMBER_HINT = "Введите число (например: 1000000):"
+# Больше — не месячная сумма, а опечатка (и риск переполнения float в годовых расчётах)
+_MAX_AMOUNT = 1e12
+
+
 async def tax_number_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ввод суммы → расчёт"""
-    text = update.message.text.strip()
-    text = text.lower().replace('ft', '').replace('huf', '').replace(' ', '').replace('\xa0', '').replace(',', '')
+    text = update.message.text.lower().translate(_NUMBER_INPUT_TABLE)
 
     try:
         amount = float(text)
         if amount <= 0:
             await update.message.reply_text("Введите положительное число:")
             return TAX_NUMBER
+        if not math.isfinite(amount) or amount > _MAX_AMOUNT:
+            await update.message.reply_text(_NUMBER_HINT)
+            return TAX_NUMBER
     except ValueError:
-        await update.message.reply_text("Введите число (например: 1000000):")
+        await update.message.reply_text(_NUMBER_HINT)
         return TAX_NUMBER
 
-    regime = context.user_data['tax_regime']
-    mode = context.user_data['tax_mode']
-    expense_pct = context.user_data.get('tax_expense_pct', 0)
-
-    wage_base = context.user_data.get('tax_wage_base', MIN_WAGE)
-    result = calc_taxes(regime, mode, amount, expense_pct, wage_base)
-
-    # Итеративная корректировка на HIPA для обратных расчётов
-    if mode in ('net', 'tax'):
-        for _ in range(10):
-            hipa_mo = calc_hipa_yearly(
-                result['revenue'] * 12, result['profit'] * 12) / 12
-            if mode == 'net':
-                adj = amount + hipa_mo
-            else:
-                adj = max(amount - hipa_mo, 0)
-            new_result = calc_taxes(regime, mode, adj, expense_pct, wage_base)
-            if abs(new_result['revenue'] - result['revenue']) < 1:
-                result = new_result
-                break
-            result = new_result
+    s = context.user_data['s']
+    regime, mode, expense_pct, wage_base = s.regime, s.mode, s.expense_pct, s.wage_base
+    # Для обратных расчётов HIPA уже входит в введённую сумму
+    result = calc_taxes_with_hipa(regime, mode, amount, expense_pct, wage_base)
 
     msg = format_tax_result(result, regime, expense_pct, mode, amount, wage_base)
 
@@ -807,6 +1043,12 @@ async def tax_number_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+async def tax_number_invalid(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Не число вместо суммы"""
+    await update.message.reply_text(_NUMBER_HINT)
+    return TAX_NUMBER
+
+
 async def tax_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """/cancel"""
     await update.message.reply_text("❌ Расчёт отменён.")
@@ -818,79 +1060,159 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """/stats — статистика (только для админа)"""
     if update.effective_user.id != ADMIN_ID:
         return
-    conn = _get_db()
-    if not conn:
+    pool = await _get_db()
+    if not pool:
         await update.message.reply_text("БД не подключена.")
         return
-    with conn.cursor() as cur:
-        cur.execute("SELECT COUNT(DISTINCT user_id) FROM stats_events WHERE event='start'")
-        total_users = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM stats_events WHERE event='calc'")
-        total_calcs = cur.fetchone()[0]
-        cur.execute(
-            "SELECT COUNT(DISTINCT user_id) FROM stats_events "
-            "WHERE event='start' AND created_at > NOW() - INTERVAL '7 days'")
-        week_users = cur.fetchone()[0]
-        cur.execute(
-            "SELECT COUNT(*) FROM stats_events "
-            "WHERE event='calc' AND created_at > NOW() - INTERVAL '7 days'")
-        week_calcs = cur.fetchone()[0]
-        cur.execute(
+    totals, top = await asyncio.gather(
+        pool.fetchrow(
+            "SELECT "
+            "(SELECT COUNT(DISTINCT user_id) FROM stats_events WHERE event='start'), "
+            "(SELECT COUNT(*) FROM stats_events WHERE event='calc'), "
+            "(SELECT COUNT(DISTINCT user_id) FROM stats_events "
+            " WHERE event='start' AND created_at > NOW() - INTERVAL '7 days'), "
+            "(SELECT COUNT(*) FROM stats_events "
+            " WHERE event='calc' AND created_at > NOW() - INTERVAL '7 days')"),
+        pool.fetch(
             "SELECT detail, COUNT(*) FROM stats_events "
-            "WHERE event='calc' GROUP BY detail ORDER BY COUNT(*) DESC LIMIT 5")
-        top = cur.fetchall()
-    msg = "📊 <b>Статистика бота</b>\n\n"
-    msg += f"<b>Всего:</b>\n"
-    msg += f"  Пользователей: {total_users}\n"
-    msg += f"  Расчётов: {total_calcs}\n\n"
-    msg += f"<b>За 7 дней:</b>\n"
-    msg += f"  Новых пользователей: {week_users}\n"
-    msg += f"  Расчётов: {week_calcs}\n"
+            "WHERE event='calc' GROUP BY detail ORDER BY COUNT(*) DESC LIMIT 5"),
+    )
+    total_users, total_calcs, week_users, week_calcs = totals
+    parts = [
+        "📊 <b>Статистика бота</b>\n\n",
+        "<b>Всего:</b>\n",
+        f"  Пользователей: {total_users}\n",
+        f"  Расчётов: {total_calcs}\n\n",
+        "<b>За 7 дней:</b>\n",
+        f"  Новых пользователей: {week_users}\n",
+        f"  Расчётов: {week_calcs}\n",
+    ]
     if top:
-        msg += "\n<b>Популярные расчёты:</b>\n"
+        parts.append("\n<b>Популярные расчёты:</b>\n")
         for detail, cnt in top:
-            parts = (detail or '').split('/')
-            regime = parts[0] if parts else '?'
-            msg += f"  {regime}: {cnt}\n"
-    await update.message.reply_text(msg, parse_mode='HTML')
+            regime = (detail or '').split('/')[0]
+            parts.append(f"  {regime}: {cnt}\n")
+    await update.message.reply_text("".join(parts), parse_mode='HTML')
 
 
 # === ЗАПУСК ===
 
+# Обработчики собираются один раз при импорте
+_TAX_HANDLER = ConversationHandler(
+    entry_points=[CommandHandler('tax', tax_start)],
+    states={
+        TAX_REGIME: [CallbackQueryHandler(tax_regime_cb, pattern=_PAT_R)],
+        TAX_COST_RATIO: [CallbackQueryHandler(tax_cost_cb, pattern=_PAT_C)],
+        TAX_EXPENSES: [
+            MessageHandler(_PERCENT_FILTER, tax_expenses_input),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, tax_expenses_invalid),
+        ],
+        TAX_WAGE_BASE: [CallbackQueryHandler(tax_wage_cb, pattern=_PAT_W)],
+        TAX_INPUT_MODE: [CallbackQueryHandler(tax_mode_cb, pattern=_PAT_M)],
+        TAX_NUMBER: [
+            # Блокирующий: с block=False диалог до конца задачи висит в PendingState
+            # и /cancel, /tax этого пользователя молча теряются
+            MessageHandler(_NUMBER_FILTER, tax_number_input),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, tax_number_invalid),
+        ],
+    },
+    fallbacks=[CommandHandler('cancel', tax_cancel)],
+    allow_reentry=True,
+    conversation_timeout=300,
+)
+
+_HANDLERS = [
+    CommandHandler('start', start),
+    CommandHandler('regimes', show_regimes),
+    CommandHandler('rates', show_rates),
+    CommandHandler('vat', show_vat),
+    CommandHandler('mrot', show_mrot),
+    CommandHandler('vnzh', show_vnzh),
+    CommandHandler('stats', show_stats, block=False),
+    _TAX_HANDLER,
+]
+
+
+@functools.cache
+def _token():
+    """Токен бота (.env уже прочитан при импорте)"""
+    return os.getenv('TAX_BOT_TOKEN')
+
+
+class _BotRequest(HTTPXRequest):
+    """HTTPXRequest, разбирающий ответы Bot API через orjson (если он установлен)"""
+
+    @staticmethod
+    def parse_json_payload(payload):
+        if orjson is not None:
+            try:
+                return orjson.loads(payload)
+            except orjson.JSONDecodeError:
+                pass  # битый UTF-8 и т.п. — разбирает и логирует стандартный путь PTB
+        return HTTPXRequest.parse_json_payload(payload)
+
+
 def main():
-    BOT_TOKEN = os.getenv('TAX_BOT_TOKEN')
+    BOT_TOKEN = _token()
     if not BOT_TOKEN:
         logger.error("TAX_BOT_TOKEN не найден в .env файле!")
         return
 
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    tax_handler = ConversationHandler(
-        entry_points=[CommandHandler('tax', tax_start)],
-        states={
-            TAX_REGIME: [CallbackQueryHandler(tax_regime_cb, pattern='^tax_r:')],
-            TAX_COST_RATIO: [CallbackQueryHandler(tax_cost_cb, pattern='^tax_c:')],
-            TAX_EXPENSES: [MessageHandler(filters.TEXT & ~filters.COMMAND, tax_expenses_input)],
-            TAX_WAGE_BASE: [CallbackQueryHandler(tax_wage_cb, pattern='^tax_w:')],
-            TAX_INPUT_MODE: [CallbackQueryHandler(tax_mode_cb, pattern='^tax_m:')],
-            TAX_NUMBER: [MessageHandler(filters.TEXT & ~filters.COMMAND, tax_number_input)],
-        },
-        fallbacks=[CommandHandler('cancel', tax_cancel)],
-        allow_reentry=True,
-        conversation_timeout=300,
+    # httpx пишет INFO-строку на каждый запрос к Bot API — оставляем только предупреждения
+    for name in ('telegram', 'httpx', 'httpcore'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    # Цикл событий на libuv: меньше накладных расходов на каждую корутину
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    # Цикл создаём явно: run_polling/run_webhook берут его через get_event_loop()
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Один пул HTTP/2-соединений к Bot API на все исходящие запросы;
+        # long poll идёт через отдельное соединение и не занимает этот пул
+        .request(_BotRequest(
+            connection_pool_size=256,
+            connect_timeout=5,
+            read_timeout=20,
+            write_timeout=20,
+            pool_timeout=10,
+            http_version='2',
+        ))
+        .get_updates_request(_BotRequest(connection_pool_size=1, http_version='2'))
+        .concurrent_updates(256)
+        # Не выше общего лимита Bot API (30 сообщений/с), 429 повторяются автоматически
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        .post_init(_start_stats_writer)
+        .post_stop(_stop_stats_writer)
+        .post_shutdown(_close_db)
+        .build()
     )
 
-    application.add_handler(CommandHandler('start', start))
-    application.add_handler(CommandHandler('regimes', show_regimes))
-    application.add_handler(CommandHandler('rates', show_rates))
-    application.add_handler(CommandHandler('vat', show_vat))
-    application.add_handler(CommandHandler('mrot', show_mrot))
-    application.add_handler(CommandHandler('vnzh', show_vnzh))
-    application.add_handler(CommandHandler('stats', show_stats))
-    application.add_handler(tax_handler)
+    application.add_handlers(_HANDLERS)
 
     logger.info("Tax bot запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # С WEBHOOK_URL апдейты приходят параллельно через вебхук, без него — long polling
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if webhook_url:
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=int(os.getenv('PORT', 8443)),
+            secret_token=os.getenv('WEBHOOK_SECRET'),
+            webhook_url=webhook_url,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        # Долгий long poll: один getUpdates висит до 50 с вместо переподключений каждые 10 с
+        application.run_polling(
+            timeout=50,
+            poll_interval=0.0,
+            bootstrap_retries=-1,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=False,
+        )
 
 
 if __name__ == '__main__':